@@ -7,85 +7,511 @@ to prepare file context, but delegates the actual diff generation to
 Claude Code's inference instead of making separate LLM API calls.
 """
 
-import argparse
+import contextlib
+import functools
+import hashlib
 import json
 import os
+import pickle
 import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 
 try:
-    from gptdiff import load_project_files, build_environment
+    import orjson
 except ImportError:
-    print("Error: gptdiff package not installed. Install with: pip install gptdiff", file=sys.stderr)
-    sys.exit(1)
+    orjson = None
+
+_load_project_files = None
+_build_environment = None
+
+
+def _gptdiff():
+    """Import gptdiff on first use.
+
+    Its import pulls in the LLM client stack, which cached loads, listings
+    and error paths never need.
+    """
+    global _load_project_files, _build_environment
+    if _load_project_files is None:
+        try:
+            from gptdiff import load_project_files, build_environment
+        except ImportError:
+            print("Error: gptdiff package not installed. Install with: pip install gptdiff", file=sys.stderr)
+            sys.exit(1)
+        _load_project_files, _build_environment = load_project_files, build_environment
+    return _load_project_files, _build_environment
+
+
+# Loaded trees are cached between invocations, since the hook runs many
+# times per session against a tree that mostly doesn't change
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "gptdiff", "prepare_context",
+)
+CACHE_VERSION = 3
+# Entries unused for a week are dropped, and the least recently used ones
+# go first once the whole cache grows past this size
+CACHE_MAX_AGE = 7 * 24 * 60 * 60
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+def _ignored_dir_matcher(root):
+    """Build a predicate for directory names that gptdiff always ignores.
+
+    Only literal ``name/`` entries are used. gptdiff drops any path that
+    contains such a pattern as a substring, so nothing below a directory with
+    that exact name is ever loaded and pruning it can't hide a change. Glob
+    entries such as ``*.egg-info/`` are only fnmatch-ed against whole paths by
+    gptdiff, so they are not pruned. Returns None (prune nothing) when there
+    are no literal entries or when a ``!`` negation could re-include
+    something below an ignored directory.
+    """
+    names = set()
+    for ignore_name in ('.gitignore', '.gptignore'):
+        try:
+            with open(os.path.join(root, ignore_name), 'r', encoding='utf-8', errors='replace') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            continue
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('!'):
+                return None
+            name = line[:-1]
+            if line.endswith('/') and name and not any(c in name for c in '/*?['):
+                names.add(name)
+    if not names:
+        return None
+    return names.__contains__
+
+
+def _tree_signature(root):
+    """Summarize a tree as (file_count, total_size, newest_mtime_ns, newest_ctime_ns).
+
+    Only stats entries, so it is much cheaper than reading the files. Any
+    added, removed, renamed or rewritten file changes the signature. The
+    ctime catches same-size replacements that carry an older mtime
+    (``cp -p``, ``rsync -a``, ``tar x``), since it can't be set back.
+    Directory symlinks are followed, as gptdiff's loader does, with each
+    directory walked once so link loops terminate. .git and ignored
+    directories (node_modules/, .venv/, ...) are not descended into.
+    """
+    is_ignored_dir = _ignored_dir_matcher(root)
+    file_count = 0
+    total_size = 0
+    root_st = os.stat(root)
+    newest = root_st.st_mtime_ns
+    newest_change = root_st.st_ctime_ns
+    visited = {(root_st.st_dev, root_st.st_ino)}
+    stack = [root]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                # gptdiff never loads anything under .git, and the loop's
+                # per-iteration commits would otherwise always change it
+                if entry.name == '.git':
+                    continue
+                try:
+                    stats = []
+                    if entry.is_symlink():
+                        # Retargeting a link changes its own ctime
+                        stats.append(entry.stat(follow_symlinks=False))
+                    if entry.is_dir():
+                        if is_ignored_dir is not None and is_ignored_dir(entry.name):
+                            continue
+                        st = entry.stat()
+                        dir_id = (st.st_dev, st.st_ino)
+                        if dir_id not in visited:
+                            visited.add(dir_id)
+                            stack.append(entry.path)
+                    else:
+                        file_count += 1
+                        st = entry.stat()
+                        total_size += st.st_size
+                    stats.append(st)
+                except OSError:
+                    continue
+                for st in stats:
+                    if st.st_mtime_ns > newest:
+                        newest = st.st_mtime_ns
+                    if st.st_ctime_ns > newest_change:
+                        newest_change = st.st_ctime_ns
+    return (file_count, total_size, newest, newest_change)
+
+
+def _cache_path(cwd, root, suffix):
+    # gptdiff matches ignore patterns against cwd-relative paths, so the
+    # same root loaded from another directory gets its own entry
+    key = hashlib.sha256(os.fsencode(cwd) + b"\0" + os.fsencode(root)).hexdigest()
+    return os.path.join(CACHE_DIR, key + suffix)
+
+
+def _cache_load(root, signature, paths_only=False):
+    """Return cached project files for root, or None if missing or stale.
+
+    With paths_only, only the small path index is read and the contents
+    come back as None.
+    """
+    cwd = os.getcwd()
+    path = _cache_path(cwd, root, ".idx" if paths_only else ".pkl")
+    try:
+        with open(path, 'rb') as f:
+            version, cached_cwd, cached_root, cached_signature, cached = pickle.load(f)
+    except Exception:
+        return None
+    if (version != CACHE_VERSION or cached_cwd != cwd or cached_root != root
+            or cached_signature != signature):
+        return None
+    try:
+        # Mark the entry as recently used for _cache_evict
+        os.utime(path)
+    except OSError:
+        pass
+    if paths_only:
+        return [(abs_path, None) for abs_path in cached]
+    return cached
+
+
+def _cache_evict():
+    """Drop entries unused for CACHE_MAX_AGE, then the least recently used
+    ones until the cache fits in CACHE_MAX_BYTES."""
+    now = time.time()
+    entries = []
+    try:
+        with os.scandir(CACHE_DIR) as it:
+            for entry in it:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if now - st.st_mtime > CACHE_MAX_AGE:
+                    _unlink_quietly(entry.path)
+                elif not entry.name.endswith(".tmp"):
+                    # In-flight temp files belong to a concurrent writer
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+    except OSError:
+        return
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= CACHE_MAX_BYTES:
+            break
+        _unlink_quietly(path)
+        total -= size
+
+
+def _unlink_quietly(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _write_pickle(path, obj):
+    """Atomically replace path with a pickle of obj."""
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _cache_store(root, signature, project_files, paths_only=False):
+    """Write project files and their path index for root to the cache (best effort).
+
+    With paths_only only the index is written: listing callers run right
+    after edits, so pickling the whole tree's contents would rarely pay off.
+    """
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        cwd = os.getcwd()
+        if not paths_only:
+            _write_pickle(_cache_path(cwd, root, ".pkl"),
+                          (CACHE_VERSION, cwd, root, signature, project_files))
+        paths = [abs_path for abs_path, _ in project_files]
+        _write_pickle(_cache_path(cwd, root, ".idx"),
+                      (CACHE_VERSION, cwd, root, signature, paths))
+    except OSError as e:
+        print(f"Warning: Could not write cache for {root}: {e}", file=sys.stderr)
+        return
+    _cache_evict()
+
+
+# Identical contents (licenses, empty stubs, ...) share one str object
+# across all targets loaded by this process
+_interned = {}
+
+
+def _intern(content):
+    return _interned.setdefault(content, content)
+
+
+@functools.lru_cache(maxsize=32)
+def _load_dir(target_dir, paths_only=False):
+    """Load (absolute_path, content) tuples for a directory, using the cache.
+
+    With paths_only the contents are None, and a cache hit reads no files.
+    Memoized for the life of the process, so a target given more than once
+    is only signed and loaded once.
+    """
+    signature = _tree_signature(target_dir)
+    project_files = _cache_load(target_dir, signature, paths_only)
+    if project_files is None:
+        load_project_files, _ = _gptdiff()
+        project_files = load_project_files(target_dir, target_dir)
+        if paths_only:
+            project_files = [(abs_path, None) for abs_path, _ in project_files]
+        else:
+            # Intern before storing, so duplicate copies are dropped here
+            # rather than kept alive by the memo, and pickle writes one copy
+            project_files = [(abs_path, _intern(content)) for abs_path, content in project_files]
+        _cache_store(target_dir, signature, project_files, paths_only)
+    elif not paths_only:
+        # Pickle keeps sharing within a tree; this shares across trees
+        project_files = [(abs_path, _intern(content)) for abs_path, content in project_files]
+    return tuple(project_files)
+
+
+def _read_utf8(path):
+    """Read a text file, replacing undecodable bytes.
+
+    Reads the raw bytes in one call and decodes them in one pass rather than
+    going through the incremental text layer. Newlines are normalized the
+    same way text mode would.
+    """
+    with open(path, 'rb') as f:
+        content = f.read().decode('utf-8', 'replace')
+    if '\r' in content:
+        content = content.replace('\r\n', '\n').replace('\r', '\n')
+    return content
+
+
+USAGE = """\
+usage: prepare_context.py [-h] [--dir DIR] [--file FILE] [--list-only] [--json] [--ndjson]
+
+Prepare file context for Claude Code
+
+options:
+  -h, --help            show this help message and exit
+  --dir DIR, -d DIR     Target directory (can specify multiple)
+  --file FILE, -f FILE  Target file (can specify multiple)
+  --list-only           Only list files, don't include content
+  --json                Output as JSON
+  --ndjson              Output one JSON object per file, one per line
+"""
+
+
+def _usage_error(message):
+    print(USAGE.split("\n\n", 1)[0], file=sys.stderr)
+    print(f"prepare_context.py: error: {message}", file=sys.stderr)
+    sys.exit(2)
+
+
+def _parse_args(argv):
+    """Parse command line arguments.
+
+    A small hand-rolled parser: the hook runs many times per session and
+    importing argparse is a noticeable share of its startup time.
+    """
+    args = SimpleNamespace(dir=[], file=[], list_only=False, json=False, ndjson=False)
+    value_options = {"--dir": args.dir, "-d": args.dir, "--file": args.file, "-f": args.file}
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        i += 1
+        if arg in ("-h", "--help"):
+            sys.stdout.write(USAGE)
+            sys.exit(0)
+        elif arg == "--list-only":
+            args.list_only = True
+        elif arg == "--json":
+            args.json = True
+        elif arg == "--ndjson":
+            args.ndjson = True
+        elif arg in value_options:
+            if i >= len(argv):
+                _usage_error(f"argument {arg}: expected one argument")
+            value_options[arg].append(argv[i])
+            i += 1
+        elif arg.startswith(("--dir=", "--file=")):
+            option, value = arg.split("=", 1)
+            value_options[option].append(value)
+        elif arg[:2] in ("-d", "-f") and len(arg) > 2:
+            value_options[arg[:2]].append(arg[2:])
+        else:
+            _usage_error(f"unrecognized arguments: {arg}")
+    return args
+
+
+def _ndjson_dumps(obj):
+    """Encode obj as compact single-line JSON bytes."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # Surrogate-escaped (non-UTF-8) filenames; see the --json path
+            pass
+    return json.dumps(obj, separators=(',', ':')).encode('ascii')
+
+
+def _write_ndjson(files_dict, list_only):
+    """Write one {"path", "content"} object per line ({"path"} with list_only).
+
+    Consumers can parse each record as it arrives instead of waiting for a
+    single top-level document.
+    """
+    # Records go straight to the binary buffer; emit any pending text first
+    sys.stdout.flush()
+    write = sys.stdout.buffer.write
+    if list_only:
+        for path in sorted(files_dict):
+            write(_ndjson_dumps({"path": path}) + b"\n")
+    else:
+        for path, content in files_dict.items():
+            write(_ndjson_dumps({"path": path, "content": content}) + b"\n")
 
 
 def main():
-    parser = argparse.ArgumentParser(description="Prepare file context for Claude Code")
-    parser.add_argument("--dir", "-d", action="append", default=[], help="Target directory (can specify multiple)")
-    parser.add_argument("--file", "-f", action="append", default=[], help="Target file (can specify multiple)")
-    parser.add_argument("--list-only", action="store_true", help="Only list files, don't include content")
-    parser.add_argument("--json", action="store_true", help="Output as JSON")
-    args = parser.parse_args()
+    args = _parse_args(sys.argv[1:])
 
     # Validate at least one target is specified
     if not args.dir and not args.file:
         # Default to current directory if nothing specified
         args.dir = ["."]
 
-    # Collect all files from all targets
-    files_dict = {}
+    # Collect (key, content) pairs from all targets; the dict is built once
+    # at the end, and later targets still win on duplicate keys
+    entries = []
+
+    # Bind the os.path helpers used per target and per file to locals
+    abspath = os.path.abspath
+    basename = os.path.basename
+    relpath = os.path.relpath
+    join = os.path.join
 
     # Process directories
-    for target_dir in args.dir:
-        target_dir = os.path.abspath(target_dir)
+    target_dirs = [abspath(target_dir) for target_dir in args.dir]
+    for target_dir in target_dirs:
         if not os.path.isdir(target_dir):
             print(f"Error: Target directory does not exist: {target_dir}", file=sys.stderr)
             sys.exit(1)
 
-        # Use gptdiff's file loading (respects .gptignore)
-        # load_project_files returns list of (absolute_path, content) tuples
-        project_files = load_project_files(target_dir, target_dir)
+    # Use gptdiff's file loading (respects .gptignore)
+    # load_project_files returns list of (absolute_path, content) tuples.
+    # Each target is an independent tree walk dominated by I/O, so scan
+    # them concurrently and fold the results in order on this thread.
+    # Repeated targets are submitted once so workers don't race to fill
+    # the same _load_dir entry.
+    # gptdiff prints progress and "Skipping file" notices to stdout while
+    # loading; send them to stderr so stdout carries only this script's
+    # output, the same on cache hits and misses. The redirect wraps the whole
+    # pool rather than each load because it swaps the process-wide
+    # sys.stdout and can't be nested safely from concurrent threads.
+    unique_dirs = list(dict.fromkeys(target_dirs))
+    if unique_dirs:
+        with contextlib.redirect_stdout(sys.stderr), \
+                ThreadPoolExecutor(max_workers=min(8, len(unique_dirs))) as executor:
+            list(executor.map(lambda d: _load_dir(d, args.list_only), unique_dirs))
+
+    for target_dir in target_dirs:
+        project_files = _load_dir(target_dir, args.list_only)
+        # Get the target dir basename to prefix the path
+        target_basename = basename(target_dir.rstrip('/'))
+        use_prefix = bool(target_basename) and target_basename != '.'
+        # target_dir is already absolute, so paths below it can be made
+        # relative by slicing instead of relpath() re-normalizing both sides
+        dir_prefix = join(target_dir, '')
+        prefix_len = len(dir_prefix)
 
         # Convert to dict with paths relative to the target directory
         for abs_path, content in project_files:
             # Use path relative to the target dir, prefixed with the target dir name
-            rel_to_target = os.path.relpath(abs_path, target_dir)
-            # Get the target dir basename to prefix the path
-            target_basename = os.path.basename(target_dir.rstrip('/'))
-            if target_basename and target_basename != '.':
-                key = os.path.join(target_basename, rel_to_target)
+            if abs_path.startswith(dir_prefix):
+                rel_to_target = abs_path[prefix_len:]
             else:
-                key = rel_to_target
-            files_dict[key] = content
+                rel_to_target = relpath(abs_path, target_dir)
+            key = join(target_basename, rel_to_target) if use_prefix else rel_to_target
+            entries.append((key, content))
 
     # Process individual files
-    for target_file in args.file:
-        target_file = os.path.abspath(target_file)
+    target_files = [abspath(target_file) for target_file in args.file]
+    for target_file in target_files:
         if not os.path.isfile(target_file):
             print(f"Error: Target file does not exist: {target_file}", file=sys.stderr)
             sys.exit(1)
 
-        try:
-            with open(target_file, 'r', encoding='utf-8', errors='replace') as f:
-                content = f.read()
-            # Use just the filename as key
-            files_dict[os.path.basename(target_file)] = content
-        except Exception as e:
-            print(f"Warning: Could not read file {target_file}: {e}", file=sys.stderr)
-
-    if args.json:
+    if args.list_only:
+        # Listing only needs the names, so skip reading the files
+        for target_file in target_files:
+            entries.append((basename(target_file), None))
+    elif target_files:
+        with ThreadPoolExecutor(max_workers=min(16, len(target_files))) as executor:
+            futures = [executor.submit(_read_utf8, target_file) for target_file in target_files]
+            for target_file, future in zip(target_files, futures):
+                try:
+                    content = future.result()
+                    content = _intern(content)
+                    # Use just the filename as key
+                    entries.append((basename(target_file), content))
+                except Exception as e:
+                    print(f"Warning: Could not read file {target_file}: {e}", file=sys.stderr)
+
+    files_dict = dict(entries)
+
+    if args.ndjson:
+        _write_ndjson(files_dict, args.list_only)
+    elif args.json:
         if args.list_only:
-            output = {"files": list(files_dict.keys())}
+            output = {"files": sorted(files_dict)}
         else:
             output = {"files": files_dict}
-        print(json.dumps(output, indent=2))
+        # orjson is optional; it emits UTF-8 bytes directly, so skip the
+        # intermediate str and write straight to the binary stdout buffer,
+        # after anything still pending in the text layer
+        sys.stdout.flush()
+        write = sys.stdout.buffer.write
+        buf = None
+        if orjson is not None:
+            try:
+                buf = orjson.dumps(output, option=orjson.OPT_INDENT_2)
+            except TypeError:
+                # orjson rejects the surrogates os.listdir uses for
+                # non-UTF-8 filenames; the stdlib encoder escapes them
+                buf = None
+        if buf is not None:
+            write(buf)
+        else:
+            # Stream chunks instead of building the whole document in memory.
+            # ensure_ascii escapes everything, including the surrogates that
+            # stand in for undecodable filename bytes.
+            encoder = json.JSONEncoder(indent=2)
+            for chunk in encoder.iterencode(output):
+                write(chunk.encode('ascii'))
+        write(b"\n")
     elif args.list_only:
-        for path in sorted(files_dict.keys()):
-            print(path)
+        # One joined write instead of a print() per path
+        if files_dict:
+            sys.stdout.write('\n'.join(sorted(files_dict)) + '\n')
     else:
         # Use gptdiff's environment builder
+        _, build_environment = _gptdiff()
         environment = build_environment(files_dict)
-        print(environment)
+        # Encode once and hand the bytes to the binary buffer, skipping the
+        # text layer's chunked re-encode of the whole environment
+        sys.stdout.flush()
+        sys.stdout.buffer.write(environment.encode('utf-8', 'surrogateescape'))
+        sys.stdout.buffer.write(b"\n")
 
 
 if __name__ == "__main__":